@@ -1,7 +1,15 @@
+import argparse
+import contextlib
+import io
 import itertools as it
+import json
+import multiprocessing as mp
+import os
+import sys
 import numpy as np
 from scipy.spatial.distance import pdist
 import time
+import tracemalloc
 
 '''
 This script finds a solution to CSP problem stated as:
@@ -15,8 +23,82 @@ def create_rows(n, rows):
     '''
     Create all possible rows which satisfy row constraints
     '''
-    row = []
-    create_row(n, row[:], rows)
+    rows.extend(list(row) for row in iter_rows(n))
+
+
+def iter_rows(n):
+    '''
+    Non-recursive generator of rows which satisfy row constraints. Rows are yielded lazily in
+    the same order as create_row builds them. Only one row is kept and changed in place,
+    every yielded row is a tuple snapshot of it
+
+    :param n: length of the row
+    :return: generator of tuples of n values {-1, 1}
+    '''
+    if n == 0:
+        yield ()
+        return
+    row = [0] * n
+    pos = 0
+    while pos >= 0:
+        # 0 means nothing tried yet on the position, -1 is tried before 1
+        if row[pos] == 0:
+            row[pos] = -1
+        elif row[pos] == -1:
+            row[pos] = 1
+        else:
+            row[pos] = 0
+            pos -= 1
+            continue
+        if pos > 1 and row[pos] == row[pos-1] == row[pos-2]:
+            continue
+        if pos == n - 1:
+            yield tuple(row)
+        else:
+            pos += 1
+
+
+def count_rows(n):
+    '''
+    Count rows which satisfy row constraints without creating them. Rows ending with a single
+    value extend both rows ending with one or two equal values, rows ending with two equal
+    values extend only rows ending with a single one
+
+    :param n: length of the row
+    :return: number of valid rows
+    '''
+    if n == 0:
+        return 1
+    single, double = 2, 0
+    for i in range(1, n):
+        single, double = single + double, single
+    return single + double
+
+
+def create_rows_array(n, count_only=False):
+    '''
+    Build all rows which satisfy row constraints at once, column by column. Every prefix is
+    extended by -1 and 1 unless its last two values are already equal to the new one
+
+    :param n: length of the row
+    :param count_only: return only number of rows (see count_rows)
+    :return: contiguous numpy array kxn of int8 values {-1, 1} with rows in the same order as
+    create_row builds them
+    '''
+    if count_only:
+        return count_rows(n)
+    rows = np.ones((1, 0), dtype=np.int8)
+    values = np.array([[-1, 1]], dtype=np.int8)
+    for i in range(n):
+        allowed = np.ones((rows.shape[0], 2), dtype=bool)
+        if i > 1:
+            equal = rows[:, -1] == rows[:, -2]
+            allowed[:, 0] = ~(equal & (rows[:, -1] == -1))
+            allowed[:, 1] = ~(equal & (rows[:, -1] == 1))
+        last = np.broadcast_to(values, allowed.shape)[allowed]
+        rows = np.repeat(rows, allowed.sum(axis=1), axis=0)
+        rows = np.concatenate([rows, last[:, np.newaxis]], axis=1)
+    return np.ascontiguousarray(rows)
 
 
 def create_row(n, row, rows):
@@ -113,7 +195,7 @@ def forward_check(matrix, domain):
     return new_domain
 
 
-def append_rows(matrix, domain):
+def append_rows(matrix, domain, stats=None):
     if matrix.shape[0] > 1:
         checked_domain = forward_check(matrix, domain)
     else:
@@ -121,28 +203,44 @@ def append_rows(matrix, domain):
     for row in checked_domain:
         '''Add vector to matrix and check constraints'''
         matrix = np.append(matrix, row, axis=0)
+        if stats is not None:
+            stats['nodes'] += 1
         # print(matrix, '\n')
         if matrix.shape[0] == matrix.shape[1] and constraint_satisfied(matrix):
             return matrix
         elif constraint_satisfied(matrix):
             actual_domain = domain[:]
             actual_domain = del_from_domain(actual_domain, row)
-            return append_rows(matrix, actual_domain)
+            return append_rows(matrix, actual_domain, stats)
         matrix = matrix[:-1, :]
     return
 
 
-def solve_mosaic(rows):
+def solve_mosaic(rows, use_transitions=False, stats=None):
+    '''
+    :param rows: [numpy array 1xn] list of rows as returned by make_rows_vectors
+    :param use_transitions: search only through rows which are legal after the previous two
+    rows by looking them up in the precomputed transition table
+    :param stats: optional dict, its 'nodes' is set to number of rows put on the board during
+    the search (counted the same way as MosaicSearch.nodes)
+    :return: numpy array nxn with the solution or None if there is no solution
+    '''
+    if use_transitions:
+        return solve_mosaic_transitions(rows, stats)
+    if stats is not None:
+        stats['nodes'] = 0
     j = 0
     for row in rows:
         j += 1
         '''Set the first row and remove it from the domain'''
         matrix = row
+        if stats is not None:
+            stats['nodes'] += 1
         domain = rows[:]
         i = 0
         domain = del_from_domain(domain, matrix)
         '''Start recurse'''
-        ret = append_rows(matrix, domain)
+        ret = append_rows(matrix, domain, stats)
         if ret is not None:
             print("SOLVED")
             print(ret)
@@ -150,7 +248,885 @@ def solve_mosaic(rows):
     print("THERE IS NO SOLUTION FOR MOSAIC PROBLEM OF SIZE", rows[0].shape[1])
     return
 
+
+'''
+Bitmask engine. Every row is kept as an n-bit integer where bit j is set when the j-th
+element of the row equals 1 (y) and cleared when it equals -1 (x). Checks on the board
+become a couple of bitwise operations instead of summing and copying numpy matrices.
+'''
+
+
+def row_to_bitmask(row):
+    '''
+    :param row: [] or numpy array 1xn of values {-1, 1}
+    :return: int - n-bit representation of the row
+    '''
+    mask = 0
+    for j, value in enumerate(np.asarray(row).ravel()):
+        if value == 1:
+            mask |= 1 << j
+    return mask
+
+
+def bitmask_to_row(mask, n):
+    '''
+    :param mask: int - n-bit representation of the row
+    :param n: length of the row
+    :return: numpy array 1xn of values {-1, 1}
+    '''
+    return np.array([[1 if mask >> j & 1 else -1 for j in range(n)]])
+
+
+def make_rows_bitmasks(rows):
+    '''
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors), or numpy
+    array kxn as returned by create_rows_array
+    :return: [int] list of rows in bitmask representation
+    '''
+    if isinstance(rows, np.ndarray) and rows.ndim == 2:
+        weights = np.left_shift(1, np.arange(rows.shape[1], dtype=np.int64))
+        return ((rows == 1) @ weights).tolist()
+    return [row_to_bitmask(row) for row in rows]
+
+
+def column_signatures(board, n):
+    '''
+    :param board: [int] rows of the board in bitmask representation
+    :param n: length of the row
+    :return: [int] list of n columns, each one packed as len(board)-bit integer
+    '''
+    signatures = []
+    for j in range(n):
+        signature = 0
+        for i, row in enumerate(board):
+            signature |= (row >> j & 1) << i
+        signatures.append(signature)
+    return signatures
+
+
+def bitmask_constraint_satisfied(board, n):
+    '''
+    Bitmask counterpart of constraint_satisfied. Three equal values in a column are found
+    with and-ing last three rows (for y) and their negations (for x), column uniqueness is
+    checked by hashing column signatures into a set once the board is square
+
+    :param board: [int] rows of the board in bitmask representation
+    :param n: length of the row
+    :return: True if the board does not break any constraint
+    '''
+    full = (1 << n) - 1
+    if len(board) > 2:
+        a, b, c = board[-3:]
+        if a & b & c or ~a & ~b & ~c & full:
+            return False
+    if len(board) == n:
+        if len(set(column_signatures(board, n))) != n:
+            return False
+    return True
+
+
+def bitmask_forward_check(board, domain, n):
+    '''
+    :param board: [int] actual state of the board
+    :param domain: [int] actual domain for choosing row to append
+    :param n: length of the row
+    :return: rows from the domain which differ from the last row in every column where
+    the last two rows are equal
+    '''
+    same = ~(board[-1] ^ board[-2]) & ((1 << n) - 1)
+    return [row for row in domain if ((row ^ board[-1]) & same) == same]
+
+
+def append_rows_bitmask(board, domain, n, stats=None):
+    if len(board) == n:
+        # only with n = 1, the first row alone is the whole board
+        return board if bitmask_constraint_satisfied(board, n) else None
+    if len(board) > 1:
+        checked_domain = bitmask_forward_check(board, domain, n)
+    else:
+        checked_domain = domain
+    for row in checked_domain:
+        board.append(row)
+        if stats is not None:
+            stats['nodes'] += 1
+        if bitmask_constraint_satisfied(board, n):
+            if len(board) == n:
+                return board
+            actual_domain = [other for other in domain if other != row]
+            if append_rows_bitmask(board, actual_domain, n, stats) is not None:
+                return board
+        board.pop()
+    return
+
+
+def solve_mosaic_bitmask(rows, stats=None):
+    '''
+    Bitmask engine counterpart of solve_mosaic
+
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors)
+    :param stats: optional dict, its 'nodes' is set to number of rows put on the board
+    :return: numpy array nxn with the solution or None if there is no solution
+    '''
+    n = np.asarray(rows[0]).size
+    masks = make_rows_bitmasks(rows)
+    if stats is not None:
+        stats['nodes'] = 0
+    for first in masks:
+        if stats is not None:
+            stats['nodes'] += 1
+        domain = [row for row in masks if row != first]
+        board = append_rows_bitmask([first], domain, n, stats)
+        if board is not None:
+            ret = np.concatenate([bitmask_to_row(row, n) for row in board], axis=0)
+            print("SOLVED")
+            print(ret)
+            return ret
+    print("THERE IS NO SOLUTION FOR MOSAIC PROBLEM OF SIZE", n)
+    return
+
+
+'''
+Transition table. The only vertical rule is that there are no three equal values in a column,
+so rows which can be appended to the board depend only on the last two rows, namely on the
+pattern of positions where they are equal and their values there. The table keeps ids of
+rows which may follow each pattern. Patterns are computed from the two rows in O(1) and
+candidate lists are built only for patterns the search reaches, so nothing of size kxk is
+built up front (the number of distinct patterns grows almost as fast as k^2).
+'''
+
+
+class TransitionTable:
+    def __init__(self, masks, n):
+        '''
+        :param masks: [int] all valid rows in bitmask representation
+        :param n: length of the row
+        '''
+        self.n = n
+        self.full = (1 << n) - 1
+        self.masks = [int(mask) for mask in masks]
+        self.masks_vector = np.asarray(self.masks, dtype=np.int64)
+        # pattern -> numpy array of ids of rows which may follow it
+        self.candidates = {}
+        # seconds spent building candidate lists
+        self.build_time = 0.0
+
+    def pattern(self, i, j):
+        '''
+        :return: int identifying which rows may follow rows i and j - positions where they are
+        equal in the upper n bits and values of row i on these positions in the lower n bits
+        '''
+        a = self.masks[i]
+        same = ~(a ^ self.masks[j]) & self.full
+        return (same << self.n) | (a & same)
+
+    def get(self, i, j):
+        '''Return numpy array of ids of rows which may follow rows i and j'''
+        pattern = self.pattern(i, j)
+        ids = self.candidates.get(pattern)
+        if ids is None:
+            start = time.perf_counter()
+            # where the two rows are equal the next one must hold the opposite value
+            same = pattern >> self.n
+            required = ~pattern & same
+            ids = np.flatnonzero((self.masks_vector & same) == required).astype(np.int32)
+            self.candidates[pattern] = ids
+            self.build_time += time.perf_counter() - start
+        return ids
+
+    def nbytes(self):
+        '''Return number of bytes used by candidate lists built so far'''
+        return self.masks_vector.nbytes + sum(ids.nbytes for ids in self.candidates.values())
+
+
+def append_rows_transitions(board, used, masks, table, n, stats=None):
+    '''
+    :param board: [int] ids of rows already put on the board
+    :param used: bytearray - used[i] is 1 if row i is already on the board
+    :param table: TransitionTable of masks
+    :param stats: optional dict, its 'nodes' is increased by every row put on the board
+    :return: board with ids of rows of the solution or None
+    '''
+    if len(board) == n:
+        # only with n = 1, the first row alone is the whole board
+        return board if len(set(column_signatures([masks[i] for i in board], n))) == n else None
+    if len(board) > 1:
+        checked_domain = table.get(board[-2], board[-1])
+    else:
+        checked_domain = range(len(masks))
+    for row in checked_domain:
+        if used[row]:
+            continue
+        board.append(row)
+        if stats is not None:
+            stats['nodes'] += 1
+        if len(board) == n:
+            if len(set(column_signatures([masks[i] for i in board], n))) == n:
+                return board
+        else:
+            used[row] = 1
+            ret = append_rows_transitions(board, used, masks, table, n, stats)
+            used[row] = 0
+            if ret is not None:
+                return ret
+        board.pop()
+    return
+
+
+def solve_mosaic_transitions(rows, stats=None):
+    '''
+    Search which iterates only over rows legal by construction according to the transition
+    table. Number of candidate lists built during the search, time of building them and their
+    memory usage are reported
+
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors)
+    :param stats: optional dict, its 'nodes' is set to number of rows put on the board
+    :return: numpy array nxn with the solution or None if there is no solution
+    '''
+    n = np.asarray(rows[0]).size
+    masks = make_rows_bitmasks(rows)
+    table = TransitionTable(masks, n)
+    used = bytearray(len(masks))
+    board = None
+    if stats is not None:
+        stats['nodes'] = 0
+    for first in range(len(masks)):
+        used[first] = 1
+        if stats is not None:
+            stats['nodes'] += 1
+        board = append_rows_transitions([first], used, masks, table, n, stats)
+        used[first] = 0
+        if board is not None:
+            break
+    print("Transition table built in", table.build_time, "s, it takes", table.nbytes(), "bytes for",
+          len(table.candidates), "candidate lists")
+    if board is not None:
+        ret = np.concatenate([bitmask_to_row(masks[i], n) for i in board], axis=0)
+        print("SOLVED")
+        print(ret)
+        return ret
+    print("THERE IS NO SOLUTION FOR MOSAIC PROBLEM OF SIZE", n)
+    return
+
+
+'''
+Parallel search. Subtrees of the search rooted in different prefixes (first row, or first
+few rows for better balance) are independent, so they are spread across a pool of worker
+processes. Each worker gets the transition table once, when it is started, and builds
+further candidate lists of its own copy as its subtrees need them.
+'''
+
+_worker_table = None
+
+
+def _init_worker(masks, table, n):
+    global _worker_table
+    _worker_table = (masks, table, n)
+
+
+def _search_prefix(prefix):
+    masks, table, n = _worker_table
+    used = bytearray(len(masks))
+    for row in prefix:
+        used[row] = 1
+    return append_rows_transitions(list(prefix), used, masks, table, n)
+
+
+def mosaic_prefixes(masks, table, depth):
+    '''
+    :param depth: number of rows in every prefix
+    :return: generator of prefixes ([int] ids of rows) in the same order as they are visited
+    by the serial search, they are made one by one as workers take them
+    '''
+    prefix = []
+    # iterators over candidates for every row of the prefix
+    stack = [iter(range(len(masks)))]
+    while stack:
+        row = next(stack[-1], None)
+        if row is None:
+            stack.pop()
+            if prefix:
+                prefix.pop()
+            continue
+        if row in prefix:
+            continue
+        prefix.append(int(row))
+        if len(prefix) == depth:
+            yield list(prefix)
+            prefix.pop()
+        elif len(prefix) > 1:
+            stack.append(iter(table.get(prefix[-2], prefix[-1])))
+        else:
+            stack.append(iter(range(len(masks))))
+
+
+def solve_mosaic_parallel(rows, workers=None, prefix_depth=1, deterministic=False, chunksize=1):
+    '''
+    Multi-process counterpart of solve_mosaic_transitions. The first worker which finds a
+    solution cancels all the others
+
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors)
+    :param workers: number of worker processes, all cores are used when None
+    :param prefix_depth: number of rows fixed in every task, deeper prefixes make more and
+    smaller tasks
+    :param deterministic: when True results are taken in order of prefixes, so the solution
+    is the same as found by the serial search
+    :param chunksize: number of prefixes sent to a worker at once. Results of a chunk come back
+    only after all its prefixes are searched, so bigger chunks save communication but delay
+    stopping at the first solution
+    :return: numpy array nxn with the solution or None if there is no solution
+    '''
+    n = np.asarray(rows[0]).size
+    if workers is None:
+        workers = os.cpu_count()
+    masks = make_rows_bitmasks(rows)
+    table = TransitionTable(masks, n)
+    prefixes = mosaic_prefixes(masks, table, max(1, min(prefix_depth, n - 1)))
+    board = None
+    with mp.Pool(workers, initializer=_init_worker, initargs=(masks, table, n)) as pool:
+        if deterministic:
+            results = pool.imap(_search_prefix, prefixes, chunksize)
+        else:
+            results = pool.imap_unordered(_search_prefix, prefixes, chunksize)
+        for ret in results:
+            if ret is not None:
+                board = ret
+                break
+        pool.terminate()
+    if board is not None:
+        ret = np.concatenate([bitmask_to_row(masks[i], n) for i in board], axis=0)
+        print("SOLVED")
+        print(ret)
+        return ret
+    print("THERE IS NO SOLUTION FOR MOSAIC PROBLEM OF SIZE", n)
+    return
+
+
+'''
+Iterative search. The board is a preallocated nxn array and the recursion is replaced with
+an explicit stack of positions in candidate lists of the transition table, so trying a row
+only writes to arrays which already exist and undoing it only clears its flag in the bitmap
+of used rows. The search can be paused after any number of nodes, inspected and resumed.
+'''
+
+
+class MosaicSearch:
+    def __init__(self, rows, symmetry_breaking=False, column_propagation=False):
+        '''
+        :param rows: list of rows as returned by create_rows (or make_rows_vectors), or numpy
+        array kxn as returned by create_rows_array
+        :param symmetry_breaking: search only canonical boards, see init_symmetries
+        :param column_propagation: prune boards whose columns cannot become unique, see
+        propagate_columns
+        '''
+        self.rows = np.asarray([np.asarray(row).ravel() for row in rows], dtype=np.int8)
+        self.n = self.rows.shape[1]
+        self.masks = make_rows_bitmasks(self.rows)
+        self.table = TransitionTable(self.masks, self.n)
+        self.all_ids = np.arange(len(self.masks), dtype=np.int32)
+        self.masks_vector = np.asarray(self.masks, dtype=np.int64)
+        self.board = np.zeros((self.n, self.n), dtype=np.int8)
+        # row id put on the board at every depth (-1 if none) and position of the next
+        # candidate to try at that depth
+        self.ids = [-1] * self.n
+        self.choice = [0] * self.n
+        self.used = bytearray(len(self.masks))
+        self.depth = 0
+        self.nodes = 0
+        self.elapsed = 0.0
+        self.symmetry_breaking = symmetry_breaking
+        if symmetry_breaking:
+            self.init_symmetries()
+        self.column_propagation = column_propagation
+        if column_propagation:
+            self.init_columns()
+
+    def init_columns(self):
+        '''
+        Columns are tracked as prefixes (bit i of the prefix is the value in row i). Every column
+        has to be one of the valid rows as well, so the number of ways to complete a prefix
+        depends only on the number of missing values and on whether the prefix ends with one
+        or two equal values: completions[0][r] and completions[1][r] respectively
+        '''
+        n = self.n
+        self.col_prefixes = [[0] * n for i in range(n + 1)]
+        single, double = [1], [1]
+        for r in range(1, n + 1):
+            single.append(single[r-1] + double[r-1])
+            double.append(single[r-1])
+        self.completions = (single, double)
+
+    def propagate_columns(self, depth, row):
+        '''
+        Extend column prefixes by the new row. Columns sharing a prefix must become different
+        in the remaining rows, so the board is pruned when a group of equal prefixes is larger
+        than the number of valid columns starting with that prefix
+
+        :return: False if the board cannot be completed to unique columns
+        '''
+        n = self.n
+        mask = self.masks[row]
+        previous = self.col_prefixes[depth]
+        current = self.col_prefixes[depth + 1]
+        groups = {}
+        for j in range(n):
+            prefix = previous[j] | (mask >> j & 1) << depth
+            current[j] = prefix
+            groups[prefix] = groups.get(prefix, 0) + 1
+        remaining = n - depth - 1
+        for prefix, size in groups.items():
+            if size > 1:
+                run = 1 if depth > 0 and (prefix >> depth & 1) == (prefix >> (depth - 1) & 1) else 0
+                if size > self.completions[run][remaining]:
+                    return False
+        return True
+
+    def init_symmetries(self):
+        '''
+        The problem does not change when x and y are swapped (negation), when order of columns
+        is reversed, when order of rows is reversed and when the board is transposed. These
+        generate a group of 16 symmetries and only the lexicographically smallest board of
+        every orbit (rows compared in order, -1 before 1) is searched.
+        Negation and column reversal map every row to another row, so they are checked
+        row by row as the board grows. Symmetries which reverse rows or transpose the board
+        are checked once the board is full.
+        '''
+        n = self.n
+        full = (1 << n) - 1
+        mask_to_id = {mask: i for i, mask in enumerate(self.masks)}
+        reversed_masks = [sum((mask >> j & 1) << (n - 1 - j) for j in range(n)) for mask in self.masks]
+        self.mask_to_id = mask_to_id
+        # key of a row compares like the row itself, first value is the most significant bit
+        self.lex_keys = reversed_masks
+        self.row_maps = [
+            [mask_to_id[~mask & full] for mask in self.masks],
+            [mask_to_id[mask] for mask in reversed_masks],
+            [mask_to_id[~mask & full] for mask in reversed_masks],
+        ]
+        # bit e of leaders[depth] is set when rows above depth are equal to rows of the board
+        # mapped by row_maps[e], so the comparison is not decided yet
+        self.leaders = [0] * (n + 1)
+        self.leaders[0] = (1 << len(self.row_maps)) - 1
+
+    def leader_prefix(self, depth, row):
+        '''
+        Check symmetries from row_maps on the new row, return False if a mapped board is
+        smaller than the board, so the board is not canonical
+        '''
+        key = self.lex_keys[row]
+        leaders = self.leaders[depth]
+        for e, row_map in enumerate(self.row_maps):
+            if leaders >> e & 1:
+                mapped = self.lex_keys[row_map[row]]
+                if mapped < key:
+                    return False
+                if key < mapped:
+                    leaders &= ~(1 << e)
+        self.leaders[depth + 1] = leaders
+        return True
+
+    def is_canonical(self):
+        '''Check that the full board is not greater than any of its 16 symmetric boards'''
+        keys = self.lex_keys
+        board = [keys[i] for i in self.ids]
+        transposed = [self.mask_to_id[mask] for mask in column_signatures([self.masks[i] for i in self.ids], self.n)]
+        for ids in (self.ids, transposed):
+            for row_map in [None] + self.row_maps:
+                mapped = ids if row_map is None else [row_map[i] for i in ids]
+                mapped = [keys[i] for i in mapped]
+                if mapped < board or mapped[::-1] < board:
+                    return False
+        return True
+
+    def domain(self, depth):
+        '''Return ids of rows which may be put on the board at the given depth'''
+        if depth > 1:
+            return self.table.get(self.ids[depth-2], self.ids[depth-1])
+        return self.all_ids
+
+    def columns_unique(self):
+        return len(set(column_signatures([self.masks[i] for i in self.ids], self.n))) == self.n
+
+    def run(self, max_nodes=None):
+        '''
+        Continue the search from where it stopped. After a solution is returned the next
+        call continues with the next one
+
+        :param max_nodes: pause after exploring this many nodes, no limit if None
+        :return: True if the board holds a solution, False if the search space is exhausted,
+        None if the search was paused
+        '''
+        start = time.perf_counter()
+        n, ids, choice, used, board = self.n, self.ids, self.choice, self.used, self.board
+        depth = self.depth
+        limit = None if max_nodes is None else self.nodes + max_nodes
+        status = False
+        while depth >= 0:
+            if limit is not None and self.nodes >= limit:
+                status = None
+                break
+            if ids[depth] >= 0:
+                used[ids[depth]] = 0
+                ids[depth] = -1
+            domain = self.domain(depth)
+            i = choice[depth]
+            while i < len(domain) and used[domain[i]]:
+                i += 1
+            if i == len(domain):
+                choice[depth] = 0
+                depth -= 1
+                continue
+            row = domain[i]
+            choice[depth] = i + 1
+            ids[depth] = row
+            used[row] = 1
+            board[depth] = self.rows[row]
+            self.nodes += 1
+            if self.symmetry_breaking and not self.leader_prefix(depth, row):
+                continue
+            if self.column_propagation and not self.propagate_columns(depth, row):
+                continue
+            if depth < n - 1:
+                depth += 1
+            elif self.columns_unique() and (not self.symmetry_breaking or self.is_canonical()):
+                status = True
+                break
+        self.depth = max(depth, 0)
+        if status is False:
+            self.depth = -1
+        self.elapsed += time.perf_counter() - start
+        return status
+
+    def nodes_per_second(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.nodes / self.elapsed
+
+    def count(self, memo_size=100000):
+        '''
+        Count all solutions of a fresh search without putting last rows on the board, they are
+        counted at once by count_last_rows. Symmetry breaking is not used for counting
+
+        :param memo_size: maximal number of counts of last rows kept in the cache, the cache is
+        cleared when it is full
+        :return: number of solutions
+        '''
+        start = time.perf_counter()
+        n, ids, choice, used = self.n, self.ids, self.choice, self.used
+        if n == 1:
+            return len(self.masks)
+        memo = {}
+        total = 0
+        depth = 0
+        while depth >= 0:
+            if ids[depth] >= 0:
+                used[ids[depth]] = 0
+                ids[depth] = -1
+            domain = self.domain(depth)
+            i = choice[depth]
+            while i < len(domain) and used[domain[i]]:
+                i += 1
+            if i == len(domain):
+                choice[depth] = 0
+                depth -= 1
+                continue
+            row = domain[i]
+            choice[depth] = i + 1
+            ids[depth] = row
+            used[row] = 1
+            self.nodes += 1
+            if self.column_propagation and not self.propagate_columns(depth, row):
+                continue
+            if depth < n - 2:
+                depth += 1
+            else:
+                total += self.count_last_rows(memo, memo_size)
+        self.depth = -1
+        self.elapsed += time.perf_counter() - start
+        return total
+
+    def count_last_rows(self, memo, memo_size):
+        '''
+        Count rows which complete the board of n-1 rows to a solution. Columns with equal
+        prefixes must get different values in the last row, so no row fits if three of them
+        are equal. The count of fitting candidates depends only on the candidate list and on
+        pairs of equal columns, so it is cached under these; rows already on the board are
+        subtracted afterwards
+        '''
+        n = self.n
+        prefix = self.ids[:n-1]
+        groups = {}
+        for j, signature in enumerate(column_signatures([self.masks[i] for i in prefix], n)):
+            groups.setdefault(signature, []).append(j)
+        pairs = []
+        for columns in groups.values():
+            if len(columns) > 2:
+                return 0
+            if len(columns) == 2:
+                pairs.append((columns[0], columns[1]))
+        pattern = self.table.pattern(prefix[-2], prefix[-1]) if n > 2 else -1
+        key = (pattern, tuple(pairs))
+        if key not in memo:
+            if len(memo) >= memo_size:
+                memo.clear()
+            masks = self.masks_vector[self.domain(n - 1)]
+            fits = np.ones(masks.shape, dtype=bool)
+            for j, k in pairs:
+                fits &= (((masks >> j) ^ (masks >> k)) & 1) == 1
+            memo[key] = int(fits.sum())
+        count = memo[key]
+        if n > 2:
+            full = (1 << n) - 1
+            last = self.masks[prefix[-1]]
+            same = ~(self.masks[prefix[-2]] ^ last) & full
+        for i in prefix:
+            mask = self.masks[i]
+            if n > 2 and ((mask ^ last) & same) != same:
+                continue
+            if all((mask >> j ^ mask >> k) & 1 for j, k in pairs):
+                count -= 1
+        return count
+
+
+def mosaic_orbit(board):
+    '''
+    :param board: numpy array nxn with the solution
+    :return: [numpy array nxn] all distinct boards obtained from board by negation, reversing
+    rows, reversing columns and transposition, all of them are new arrays (board itself may be
+    changed later, e.g. the board of MosaicSearch)
+    '''
+    orbit = {}
+    for transposed in (board, board.T):
+        for rows_reversed in (transposed, transposed[::-1]):
+            for columns_reversed in (rows_reversed, rows_reversed[:, ::-1]):
+                for negated in (columns_reversed, -columns_reversed):
+                    orbit.setdefault(negated.tobytes(), np.array(negated))
+    return list(orbit.values())
+
+
+def iter_mosaic_solutions(rows, symmetry_breaking=False, stats=None, column_propagation=False):
+    '''
+    Generator of all solutions, boards are yielded as soon as they are found and none of them
+    is stored
+
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors), or numpy
+    array kxn as returned by create_rows_array
+    :param symmetry_breaking: search only canonical boards and yield the whole orbit of each
+    :param stats: optional dict updated with numbers of solutions and nodes, seconds elapsed
+    and solutions per second
+    :param column_propagation: prune boards whose columns cannot become unique
+    :return: generator of numpy arrays nxn
+    '''
+    search = MosaicSearch(rows, symmetry_breaking, column_propagation)
+    if stats is None:
+        stats = {}
+    stats.update(solutions=0, nodes=0, seconds=0.0, solutions_per_second=0.0)
+    start = time.perf_counter()
+    while search.run():
+        if symmetry_breaking:
+            boards = mosaic_orbit(search.board)
+        else:
+            boards = [search.board.copy()]
+        for board in boards:
+            stats['solutions'] += 1
+            stats['nodes'] = search.nodes
+            stats['seconds'] = time.perf_counter() - start
+            stats['solutions_per_second'] = stats['solutions'] / stats['seconds']
+            yield board
+    stats['nodes'] = search.nodes
+    stats['seconds'] = time.perf_counter() - start
+    if stats['seconds'] > 0:
+        stats['solutions_per_second'] = stats['solutions'] / stats['seconds']
+
+
+def check_mosaic_orbits(n):
+    '''
+    Check that solutions streamed with symmetry breaking (orbits of canonical boards) are
+    exactly the solutions streamed without it
+
+    :param n: size of the board
+    :return: (True if both sets of boards are equal, number of solutions)
+    '''
+    rows = create_rows_array(n)
+    plain = {board.tobytes() for board in iter_mosaic_solutions(rows)}
+    boards = list(iter_mosaic_solutions(rows, symmetry_breaking=True))
+    orbits = {board.tobytes() for board in boards}
+    return orbits == plain and len(boards) == len(orbits), len(plain)
+
+
+def count_mosaic_solutions(rows, memo_size=100000, column_propagation=False):
+    '''
+    Count all solutions without creating boards, see MosaicSearch.count
+
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors), or numpy
+    array kxn as returned by create_rows_array
+    :param memo_size: maximal number of cached counts of last rows
+    :param column_propagation: prune boards whose columns cannot become unique
+    :return: number of solutions
+    '''
+    search = MosaicSearch(rows, column_propagation=column_propagation)
+    solutions = search.count(memo_size)
+    print("Counted", solutions, "solutions in", search.elapsed, "s,",
+          solutions / search.elapsed if search.elapsed else 0.0, "solutions/s")
+    return solutions
+
+
+def solve_mosaic_iterative(rows, symmetry_breaking=False, column_propagation=False):
+    '''
+    Iterative counterpart of solve_mosaic_transitions, see MosaicSearch
+
+    :param rows: list of rows as returned by create_rows (or make_rows_vectors), or numpy
+    array kxn as returned by create_rows_array
+    :param symmetry_breaking: search only canonical boards, mosaic_orbit expands the solution
+    to its symmetric boards
+    :param column_propagation: prune boards whose columns cannot become unique
+    :return: numpy array nxn with the solution or None if there is no solution
+    '''
+    search = MosaicSearch(rows, symmetry_breaking, column_propagation)
+    status = search.run()
+    print("Explored", search.nodes, "nodes,", search.nodes_per_second(), "nodes/s")
+    if status:
+        print("SOLVED")
+        print(search.board)
+        return search.board.copy()
+    print("THERE IS NO SOLUTION FOR MOSAIC PROBLEM OF SIZE", search.n)
+    return
+
+
+'''
+Benchmark. Every engine is run for a range of sizes without any interaction and a record
+with row generation time, search time, number of nodes (rows put on the board, counted the
+same way by every engine), peak memory and share of search time spent in the constraint check
+and in the forward check of the engine is written for every size as one JSON line. Timings come from an instrumented run, so they include its overhead, peak
+memory is measured in a separate run under tracemalloc.
+'''
+
+BENCHMARK_ENGINES = {
+    'numpy': {'constraint': 'constraint_satisfied', 'forward_check': 'forward_check'},
+    'bitmask': {'constraint': 'bitmask_constraint_satisfied', 'forward_check': 'bitmask_forward_check'},
+    'transitions': {'constraint': 'column_signatures', 'forward_check': None},
+    'iterative': {'constraint': 'MosaicSearch.columns_unique', 'forward_check': 'MosaicSearch.domain'},
+    'propagation': {'constraint': 'MosaicSearch.propagate_columns', 'forward_check': 'MosaicSearch.domain'},
+}
+
+
+def _instrument(name, calls, seconds):
+    '''
+    Replace function (or method of a class in CSP.py given as Class.method) with a wrapper
+    counting its calls and time spent in it
+
+    :return: function restoring the original one
+    '''
+    owner = sys.modules[__name__]
+    attribute = name
+    if '.' in name:
+        class_name, attribute = name.split('.')
+        owner = getattr(owner, class_name)
+    function = vars(owner)[attribute]
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            calls[name] = calls.get(name, 0) + 1
+            seconds[name] = seconds.get(name, 0.0) + time.perf_counter() - start
+
+    setattr(owner, attribute, wrapper)
+    return lambda: setattr(owner, attribute, function)
+
+
+def _benchmark_rows(engine, n):
+    if engine == 'numpy':
+        rows = []
+        create_rows(n, rows)
+        return make_rows_vectors(rows)
+    return create_rows_array(n)
+
+
+def _benchmark_search(engine, rows):
+    '''
+    :return: (True if solved, number of nodes - rows put on the board, counted the same way
+    by every engine)
+    '''
+    stats = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine in ('iterative', 'propagation'):
+            search = MosaicSearch(rows, column_propagation=engine == 'propagation')
+            return bool(search.run()), search.nodes
+        if engine == 'numpy':
+            solved = solve_mosaic(rows, stats=stats) is not None
+        elif engine == 'bitmask':
+            solved = solve_mosaic_bitmask(rows, stats) is not None
+        else:
+            solved = solve_mosaic_transitions(rows, stats) is not None
+    return solved, stats['nodes']
+
+
+def benchmark_mosaic(sizes, engines=None, output="mosaic_benchmark.jsonl"):
+    '''
+    :param sizes: iterable of board sizes
+    :param engines: names of engines from BENCHMARK_ENGINES, all of them if None
+    :param output: path of JSON lines file with results
+    :return: [dict] list of records written to the output
+    '''
+    if engines is None:
+        engines = list(BENCHMARK_ENGINES)
+    records = []
+    with open(output, 'w') as file:
+        for engine in engines:
+            names = BENCHMARK_ENGINES[engine]
+            for n in sizes:
+                calls, seconds = {}, {}
+                restore = [_instrument(name, calls, seconds) for name in names.values() if name]
+                try:
+                    start = time.perf_counter()
+                    rows = _benchmark_rows(engine, n)
+                    row_time = time.perf_counter() - start
+                    start = time.perf_counter()
+                    solved, nodes = _benchmark_search(engine, rows)
+                    search_time = time.perf_counter() - start
+                finally:
+                    for undo in restore:
+                        undo()
+                tracemalloc.start()
+                _benchmark_search(engine, _benchmark_rows(engine, n))
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                record = {'engine': engine, 'n': n, 'rows': len(rows), 'solved': solved,
+                          'row_time': row_time, 'search_time': search_time, 'nodes': nodes,
+                          'peak_memory': peak_memory}
+                for check in ('constraint', 'forward_check'):
+                    name = names[check]
+                    record[check] = name
+                    record[check + '_calls'] = calls.get(name, 0)
+                    record[check + '_share'] = seconds.get(name, 0.0) / search_time if search_time else 0.0
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                records.append(record)
+                print(engine, "n =", n, "search", search_time, "s,", nodes, "nodes,",
+                      peak_memory, "bytes peak")
+    return records
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve mosaic problem, or benchmark its solvers "
+                                                 "when sizes are given")
+    parser.add_argument("--sizes", type=int, nargs=2, metavar=("MIN", "MAX"),
+                        help="benchmark all sizes from MIN to MAX inclusive")
+    parser.add_argument("--engines", nargs="+", choices=list(BENCHMARK_ENGINES),
+                        help="engines to benchmark, all by default")
+    parser.add_argument("--output", default="mosaic_benchmark.jsonl",
+                        help="JSON lines file with benchmark results")
+    parser.add_argument("--check", type=int, metavar="MAX",
+                        help="check symmetry breaking against plain search for sizes 2 to MAX")
+    args = parser.parse_args()
+    if args.check:
+        for n in range(2, args.check + 1):
+            equal, solutions = check_mosaic_orbits(n)
+            print("n =", n, solutions, "solutions,", "ok" if equal else "MISMATCH")
+        raise SystemExit
+    if args.sizes:
+        benchmark_mosaic(range(args.sizes[0], args.sizes[1] + 1), args.engines, args.output)
+        raise SystemExit
     map_size = int(input("Please specify the size: "))
     start = time.time()
     all_rows = []
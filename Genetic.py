@@ -1,14 +1,22 @@
+import argparse
+import csv
+import json
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os
 import random
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.spatial.distance import cdist
 import time
+import tracemalloc
 
 
 class Polynomial:
     def __init__(self, parameters):
         self.params = parameters
         self.degree = self.params.shape[0] - 1
+        # increased on every change of parameters, so cached values can be told from stale ones
+        self.version = 0
 
     def get_value(self, x):
         ret_val = self.params[self.degree]
@@ -21,40 +29,361 @@ class Polynomial:
 
     def change_param(self, position, value):
         self.params[position] += value
+        self.version += 1
+
+
+def vandermonde(x, degree):
+    '''
+    :param x: vector of x coordinates of points
+    :param degree: degree of polynomials
+    :return: matrix len(x) x (degree+1) of powers of x, the highest power first like in
+    Polynomial.params
+    '''
+    return np.vander(x, degree + 1)
+
+
+def population_fitness(coefficients, points, vander=None, block_size=2**22):
+    '''
+    Fitness of many polynomials at once. Values of all polynomials in all points are one matrix
+    product of the vandermonde matrix of points and the coefficients, classification is a
+    vectorized sign comparison. Points are processed in chunks so that no more than block_size
+    values are kept at a time
+
+    :param coefficients: matrix pop x (degree+1) of parameters of polynomials
+    :param points: matrix nx3 (x, y, class) && class = {-1, 1}, or numpy memmap or ChunkedPoints
+    for point sets which do not fit in memory (fitness is accumulated chunk by chunk, see
+    is_streamed)
+    :param vander: vandermonde matrix of x coordinates of points, computed if not given
+    :param block_size: maximal number of values of polynomials computed at once
+    :return: vector of pop fitness values <0, 1>
+    '''
+    if isinstance(points, np.memmap) and vander is None:
+        points = ChunkedPoints(points)
+    if isinstance(points, ChunkedPoints):
+        correct = np.zeros(coefficients.shape[0], dtype=np.int64)
+        for chunk in points:
+            correct += count_correct(coefficients, chunk, None, block_size)
+        return correct / len(points)
+    return count_correct(coefficients, points, vander, block_size) / points.shape[0]
+
+
+def is_streamed(points):
+    '''
+    Return True if points are read chunk by chunk instead of being kept in memory together
+    with their vandermonde matrix, that is for ChunkedPoints and numpy memmap (e.g. returned by
+    generate_points with path or np.load with mmap_mode)
+    '''
+    return isinstance(points, (ChunkedPoints, np.memmap))
+
+
+class ChunkedPoints:
+    def __init__(self, source, chunk_size=2**20):
+        '''
+        Point set read chunk by chunk, it can be iterated over many times
+
+        :param source: path of .npy file with matrix nx3 (opened memory-mapped), matrix nx3 (e.g.
+        numpy memmap) or function returning new iterator over nx3 chunks on every call
+        :param chunk_size: number of points in chunks read from a file or matrix
+        '''
+        self.chunk_size = chunk_size
+        self.array = None
+        self.factory = None
+        if isinstance(source, (str, os.PathLike)):
+            self.array = np.load(source, mmap_mode='r')
+        elif callable(source):
+            self.factory = source
+        else:
+            self.array = source
+        self.size = None if self.array is None else self.array.shape[0]
+
+    def __iter__(self):
+        if self.array is not None:
+            for start in range(0, self.array.shape[0], self.chunk_size):
+                yield np.asarray(self.array[start:start + self.chunk_size])
+        else:
+            size = 0
+            for chunk in self.factory():
+                chunk = np.asarray(chunk)
+                size += chunk.shape[0]
+                yield chunk
+            self.size = size
+
+    def __len__(self):
+        if self.size is None:
+            self.size = sum(chunk.shape[0] for chunk in self)
+        return self.size
+
+
+def fitness_chunk_size(pop, block_size=2**22):
+    '''Return number of points evaluated at once for population of pop individuals'''
+    return max(1, block_size // pop)
+
+
+def count_correct(coefficients, points, vander=None, block_size=2**22):
+    '''
+    :return: vector of numbers of points classified correctly by every polynomial, see
+    population_fitness
+    '''
+    if vander is None:
+        vander = vandermonde(points[:, 0], coefficients.shape[1] - 1)
+    correct = np.zeros(coefficients.shape[0], dtype=np.int64)
+    chunk_size = fitness_chunk_size(coefficients.shape[0], block_size)
+    for start in range(0, points.shape[0], chunk_size):
+        chunk = points[start:start + chunk_size]
+        values = vander[start:start + chunk_size] @ coefficients.T
+        classification_distances = (chunk[:, 1, np.newaxis] - values) * chunk[:, 2, np.newaxis]
+        correct += np.count_nonzero(classification_distances > 0, axis=0)
+    return correct
+
+
+'''
+Multi-process evaluation. Points are copied once into shared memory, which every worker of the
+pool attaches to when it starts, so only coefficients and ranges of points are sent with tasks.
+Points are split between workers along the same chunks as population_fitness processes them, so
+every matrix product has the same operands as in serial evaluation and the result is identical.
+'''
+
+_worker_memory = None
+_worker_points = None
+_worker_vanders = {}
+
+
+def _attach_points(name, shape, dtype):
+    global _worker_memory, _worker_points
+    _worker_memory = shared_memory.SharedMemory(name=name)
+    _worker_points = np.ndarray(shape, dtype=dtype, buffer=_worker_memory.buf)
+    _worker_vanders.clear()
+
+
+def _count_shared(task):
+    coefficients, start, stop, block_size = task
+    key = (start, stop, coefficients.shape[1])
+    if key not in _worker_vanders:
+        _worker_vanders[key] = vandermonde(_worker_points[start:stop, 0], coefficients.shape[1] - 1)
+    return count_correct(coefficients, _worker_points[start:stop], _worker_vanders[key], block_size)
+
+
+class ProcessFitnessEvaluator:
+    def __init__(self, workers=None, min_size=2**20, block_size=2**22):
+        '''
+        Drop-in replacement of population_fitness evaluating it in a pool of processes
+
+        :param workers: number of worker processes, all cores are used when None
+        :param min_size: populations with pop * number of points below this are evaluated serially
+        :param block_size: see population_fitness
+        '''
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.min_size = min_size
+        self.block_size = block_size
+        self.pool = None
+        self.memory = None
+        self.points = None
+
+    def share_points(self, points):
+        '''Copy points into shared memory and start workers attached to it'''
+        self.close()
+        points = np.ascontiguousarray(points)
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, points.nbytes))
+        np.ndarray(points.shape, dtype=points.dtype, buffer=self.memory.buf)[...] = points
+        self.pool = mp.Pool(self.workers, initializer=_attach_points,
+                            initargs=(self.memory.name, points.shape, points.dtype))
+
+    def __call__(self, coefficients, points, vander=None):
+        if is_streamed(points) or self.workers < 2 or \
+                coefficients.shape[0] * points.shape[0] < self.min_size:
+            return population_fitness(coefficients, points, vander, self.block_size)
+        if self.points is not points:
+            self.share_points(points)
+            self.points = points
+        chunk_size = fitness_chunk_size(coefficients.shape[0], self.block_size)
+        chunks = -(-points.shape[0] // chunk_size)
+        bounds = [chunk_size * (chunks * i // self.workers) for i in range(self.workers + 1)]
+        tasks = [(coefficients, start, min(stop, points.shape[0]), self.block_size)
+                 for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+        return sum(self.pool.map(_count_shared, tasks)) / points.shape[0]
+
+    def close(self):
+        '''Stop workers and release shared memory'''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+        self.points = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class Individual:
-    def __init__(self, params=None):
+    # number of fitness values taken from caches of individuals and computed again
+    cache_hits = 0
+    cache_misses = 0
+
+    def __init__(self, params=None, degree=3):
         if params is not None:
             self.polynomial = Polynomial(params)
         else:
-            self.polynomial = Polynomial(np.array([random.uniform(-10.0, 10.0), random.uniform(-10.0, 10.0),
-                                                   random.uniform(-10.0, 10.0), random.uniform(-10.0, 10.0)]))
+            self.polynomial = Polynomial(np.array([random.uniform(-10.0, 10.0) for i in range(degree + 1)]))
+        self.fitness = None
+        self.fitness_points = None
+        self.fitness_version = None
+
+    def get_cached_fitness(self, points):
+        '''
+        Return fitness cached for the same points and current parameters of the polynomial
+        (it is invalidated by Polynomial.change_param), None if there is no such value
+        '''
+        if self.fitness_points is points and self.fitness_version == self.polynomial.version:
+            Individual.cache_hits += 1
+            return self.fitness
+        Individual.cache_misses += 1
+        return None
+
+    def set_cached_fitness(self, points, fitness):
+        self.fitness = float(fitness)
+        self.fitness_points = points
+        self.fitness_version = self.polynomial.version
 
     def calc_fitness(self, points):
-        flat_distances = (points[:, 1] - self.polynomial.get_value(points[:, 0]))
-        classification_distances = flat_distances * points[:, 2].transpose()
-        fitness = 0
-        for i in range(0, classification_distances.shape[0]):
-            if classification_distances[i] > 0:
-                fitness += 1
-        return fitness/points.shape[0]
+        fitness = self.get_cached_fitness(points)
+        if fitness is None:
+            fitness = population_fitness(self.polynomial.params[np.newaxis, :], points)[0]
+            self.set_cached_fitness(points, fitness)
+        return self.fitness
+
+
+class Termination:
+    def __init__(self, max_generations=None, target_fitness=None, time_budget=None, evaluation_budget=None,
+                 stagnation_window=None, min_improvement=0.0):
+        '''
+        Conditions of stopping Population.run, unused ones are None
+
+        :param max_generations: stop once the population reaches this generation
+        :param target_fitness: stop once the best fitness reaches this value
+        :param time_budget: stop after this many seconds of the run
+        :param evaluation_budget: stop once the population made this many fitness evaluations
+        :param stagnation_window: stop when neither the best nor the average fitness improved by
+        more than min_improvement in this many last generations
+        :param min_improvement: smallest change of fitness counted as improvement
+        '''
+        self.max_generations = max_generations
+        self.target_fitness = target_fitness
+        self.time_budget = time_budget
+        self.evaluation_budget = evaluation_budget
+        self.stagnation_window = stagnation_window
+        self.min_improvement = min_improvement
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def stagnated(self, population):
+        window = self.stagnation_window
+        best = population.best_fit_history
+        avg = population.avg_fit_history
+        if len(best) <= window:
+            return False
+        best_improved = max(best[-window:]) > max(best[:-window]) + self.min_improvement
+        avg_improved = max(avg[-window:]) > max(avg[:-window]) + self.min_improvement
+        return not best_improved and not avg_improved
+
+    def check(self, population):
+        '''Return reason of stopping the run of population or None if it should go on'''
+        if self.target_fitness is not None and population.best_fit >= self.target_fitness:
+            return 'target_fitness'
+        if self.max_generations is not None and population.generation >= self.max_generations:
+            return 'max_generations'
+        if self.evaluation_budget is not None and population.evaluations >= self.evaluation_budget:
+            return 'evaluation_budget'
+        if self.time_budget is not None and time.perf_counter() - self.start_time >= self.time_budget:
+            return 'time_budget'
+        if self.stagnation_window is not None and self.stagnated(population):
+            return 'stagnation'
+        return None
 
 
 class Population:
-    def __init__(self, pop):
+    def __init__(self, pop, seed=None, evaluator=population_fitness, degree=3):
         """create population of polynomials
 
         :param pop: (int)Number of individuals in population
+        :param seed: seed of numpy random generator, all random choices of the population are
+        made with it
+        :param evaluator: function (coefficients, points, vander) -> vector of fitness values,
+        e.g. population_fitness or ProcessFitnessEvaluator. Samples of minibatch mode are new
+        arrays in every generation, so they are always evaluated serially by population_fitness
+        :param degree: degree of polynomials of individuals
 
         """
-        self.best_individual = Individual()
+        self.rng = np.random.default_rng(seed)
+        self.evaluator = evaluator
+        # number of individuals whose fitness was computed (not taken from the cache)
+        self.evaluations = 0
+        self.best_individual = Individual(params=self.rng.uniform(-10.0, 10.0, size=degree + 1))
         self.generation = 0
         self.best_fit = 0.0
         self.population = []
         for i in range(0, pop):
-            new_individual = Individual()
+            new_individual = Individual(params=self.rng.uniform(-10.0, 10.0, size=degree + 1))
             self.population.append(new_individual)
+        self.pack_coefficients()
+        self.vander_points = None
+        self.vander = None
+        # points drawn by the last sample_points
+        self.sample = None
+        # (estimated fitness, individual) of the best individuals found in minibatch mode
+        self.elite = []
+        # average and best fitness over all generations evolved by run
+        self.avg_fit_history = []
+        self.best_fit_history = []
+        # reason why the last run stopped, see Termination.check
+        self.stop_reason = None
+        # fitness values cached by individuals when the checkpoint was saved, NaN if none
+        self.checkpoint_fitness = None
+
+    def pack_coefficients(self):
+        '''
+        Store parameters of all individuals as one matrix pop x (degree+1), polynomials of
+        individuals keep views of its rows, so changing them changes the matrix
+        '''
+        self.coefficients = np.array([individual.polynomial.params for individual in self.population],
+                                     dtype=float)
+        for individual, params in zip(self.population, self.coefficients):
+            individual.polynomial.params = params
+
+    def get_vandermonde(self, points):
+        '''Return vandermonde matrix of points, computed only when points change'''
+        if is_streamed(points):
+            return None
+        if self.vander_points is not points:
+            self.vander = vandermonde(points[:, 0], self.coefficients.shape[1] - 1)
+            self.vander_points = points
+        return self.vander
+
+    def calc_fitness_vector(self, points):
+        '''Return vector of fitness values of all individuals, only those not cached are computed'''
+        fitness_vector = np.empty(len(self.population))
+        missing = []
+        for i, individual in enumerate(self.population):
+            fitness = individual.get_cached_fitness(points)
+            if fitness is None:
+                missing.append(i)
+            else:
+                fitness_vector[i] = fitness
+        if missing:
+            self.evaluations += len(missing)
+            evaluator = population_fitness if points is self.sample else self.evaluator
+            fitness_vector[missing] = evaluator(self.coefficients[missing], points, self.get_vandermonde(points))
+            for i in missing:
+                self.population[i].set_cached_fitness(points, fitness_vector[i])
+        return fitness_vector
 
     def get_pop(self):
         return len(self.population)
@@ -63,152 +392,481 @@ class Population:
         return self.generation
 
     def get_bestfit(self, points):
-        for individual in self.population:
-            fit = individual.calc_fitness(points)
-            if fit > self.best_fit:
-                self.best_fit = fit
-                self.best_individual = individual
+        fitness_vector = self.calc_fitness_vector(points)
+        best = int(np.argmax(fitness_vector))
+        if fitness_vector[best] > self.best_fit:
+            self.best_fit = float(fitness_vector[best])
+            self.best_individual = Individual(params=self.coefficients[best].copy())
 
     def get_avgfit(self, points):
-        fitness_sum = 0.0
-        for individual in self.population:
-            fitness_sum += individual.calc_fitness(points)
-        return fitness_sum/len(self.population)
+        return float(np.mean(self.calc_fitness_vector(points)))
 
     def get_fitness_list(self, points):
-        fitness_list = []
-        for individual in self.population:
-            fitness_list.append(individual.calc_fitness(points))
-        return fitness_list
+        return self.calc_fitness_vector(points).tolist()
+
+    def emigrate(self, points, count):
+        '''Return matrix count x (degree+1) of parameters of the best individuals'''
+        best = np.argsort(self.calc_fitness_vector(points))[::-1][:count]
+        return self.coefficients[best].copy()
+
+    def immigrate(self, points, coefficients):
+        '''Replace the worst individuals with new ones with given parameters'''
+        worst = np.argsort(self.calc_fitness_vector(points))[:coefficients.shape[0]]
+        self.coefficients[worst] = coefficients
+        for i in worst:
+            self.population[i] = Individual(params=self.coefficients[i])
 
     def calc_spatial_distances(self, individual_params):
-        poly_vector = []
-        for individual in self.population:
-            poly_vector.append(individual.polynomial.params)
-        poly_vector = np.asarray(poly_vector)
-        distances = cdist(poly_vector, individual_params, 'euclidean')
+        distances = cdist(self.coefficients, individual_params, 'euclidean')
         return distances/sum(distances)
 
+    def calc_distance_matrix(self):
+        '''Return matrix pop x pop of distances between individuals, every column sums up to 1'''
+        distances = cdist(self.coefficients, self.coefficients, 'euclidean')
+        return distances/distances.sum(axis=0)
+
     @staticmethod
     def calc_probabilities(fitness_list):
-        fitness_sum = 0.0
-        probability_list = []
-        for fitness_value in fitness_list:
-            probability_list.append(fitness_value)
-            fitness_sum += fitness_value
-        # transpose fitness value into probability (fitness/sum of finesses)
-        return [fitness_value / fitness_sum for fitness_value in probability_list]
+        # transpose fitness value into probability (fitness/sum of finesses), None means uniform
+        fitness_vector = np.asarray(fitness_list, dtype=float)
+        fitness_sum = fitness_vector.sum()
+        if fitness_sum <= 0:
+            return None
+        return fitness_vector / fitness_sum
+
+    def select_parents(self, fitness_vector):
+        '''
+        Draw all parents of the next generation at once. First parents are winners of tournaments
+        of 5 individuals drawn with probability proportional to fitness, second parents are drawn
+        with weights equal to fitness times distance from the first parent. Distances and
+        probabilities are computed once per generation
+
+        :param fitness_vector: vector of fitness values of individuals
+        :return: (vector of indices of first parents, vector of indices of second parents)
+        '''
+        pop = len(self.population)
+        pairs = int(pop/2)
+        tournaments = self.rng.choice(pop, size=(pairs, 5), p=self.calc_probabilities(fitness_vector))
+        first = tournaments[np.arange(pairs), np.argmax(fitness_vector[tournaments], axis=1)]
+        weights = fitness_vector[np.newaxis, :] * self.calc_distance_matrix()[:, first].transpose()
+        cumulative = np.cumsum(weights, axis=1)
+        draws = self.rng.random(pairs) * cumulative[:, -1]
+        second = np.minimum(np.count_nonzero(cumulative <= draws[:, np.newaxis], axis=1), pop - 1)
+        return first, second
 
     def crossover(self, points, fitness_list):
-        parents_first = []
-        for i in range(0, int(len(self.population)/2)):
-            tournament = random.choices(self.population, weights=self.calc_probabilities(fitness_list),
-                                        k=5)
-            best_fit = 0.0
-            best_parent = Individual()
-            for parent in tournament:
-                if parent.calc_fitness(points) > best_fit:
-                    best_fit = parent.calc_fitness(points)
-                    best_parent = parent
-            parents_first.append(best_parent)
-        fitness_vector = np.asarray(fitness_list)
-        parents = []
-        for first_parent in parents_first:
-            second_parent = random.choices(
-                self.population,
-                weights=(fitness_vector * self.calc_spatial_distances(
-                    first_parent.polynomial.params[:, np.newaxis].transpose()).transpose()).transpose(), k=1)
-            parents.append((first_parent, second_parent[0]))
-        children = []
-        for pair in parents:
-            crossover_position = random.randrange(0, pair[0].polynomial.degree+1)
-            first_child = Individual(params=np.append(pair[0].polynomial.params[0:crossover_position],
-                                                      pair[1].polynomial.params[crossover_position:]))
-            second_child = Individual(params=np.append(pair[1].polynomial.params[0:crossover_position],
-                                                       pair[0].polynomial.params[crossover_position:]))
-            children.append(first_child)
-            children.append(second_child)
-        self.population = children
+        first, second = self.select_parents(np.asarray(fitness_list, dtype=float))
+        self.recombine(first, second)
+
+    def recombine(self, first, second):
+        '''Replace population with children of pairs of parents given by their indices'''
+        first_parents = self.coefficients[first]
+        second_parents = self.coefficients[second]
+        degree = self.coefficients.shape[1] - 1
+        crossover_positions = self.rng.integers(0, degree+1, size=first.shape[0])
+        # child takes parameters before crossover position from one parent and the rest from the other
+        from_first = np.arange(degree+1)[np.newaxis, :] < crossover_positions[:, np.newaxis]
+        children = np.empty((2*first.shape[0], degree+1))
+        children[0::2] = np.where(from_first, first_parents, second_parents)
+        children[1::2] = np.where(from_first, second_parents, first_parents)
+        self.coefficients = children
+        self.population = [Individual(params=params) for params in children]
 
     def mutation(self, mutation_probability):
-        for individual in self.population:
-            if random.randrange(0, 100) < mutation_probability*100:
-                for i in range(0, individual.polynomial.degree+1):
-                    individual.polynomial.change_param(i, random.uniform(-10.0, 10.0))
+        mutated = np.flatnonzero(self.rng.random(len(self.population)) < mutation_probability)
+        changes = self.rng.uniform(-10.0, 10.0, size=(mutated.shape[0], self.coefficients.shape[1]))
+        for i, change in zip(mutated, changes):
+            for position, value in enumerate(change):
+                self.population[i].polynomial.change_param(position, value)
 
-    def evolve_generation(self, points, _avg_fit, _best_fit, mutation_probability):
+    def sample_points(self, points, size):
+        '''
+        :param points: matrix nx3 or ChunkedPoints backed by a file or matrix
+        :param size: number of points in the sample
+        :return: matrix size x 3 of points drawn without replacement
+        '''
+        array = points.array if isinstance(points, ChunkedPoints) else points
+        if array is None:
+            raise ValueError("Minibatch mode needs points which can be indexed, not an iterator")
+        if size >= array.shape[0]:
+            self.sample = np.asarray(array)
+        else:
+            indices = np.sort(self.rng.choice(array.shape[0], size=size, replace=False))
+            self.sample = np.asarray(array[indices])
+        return self.sample
+
+    def update_elite(self, points, elite_size):
+        '''Keep elite_size individuals with the best fitness estimated so far'''
+        fitness_vector = self.calc_fitness_vector(points)
+        for i in np.argsort(fitness_vector)[::-1][:elite_size]:
+            self.elite.append((float(fitness_vector[i]), Individual(params=self.coefficients[i].copy())))
+        self.elite.sort(key=lambda pair: pair[0], reverse=True)
+        del self.elite[elite_size:]
+
+    def evaluate_elite(self, points):
+        '''Evaluate the elite on all points and make its best individual the best one'''
+        if not self.elite:
+            return
+        coefficients = np.array([individual.polynomial.params for _, individual in self.elite])
+        fitness_vector = self.evaluator(coefficients, points, None)
+        best = int(np.argmax(fitness_vector))
+        self.best_fit = float(fitness_vector[best])
+        self.best_individual = self.elite[best][1]
+
+    def evolve_generation(self, points, _avg_fit, _best_fit, mutation_probability, minibatch=None,
+                          elite_size=10, metrics=None):
+        '''
+        Evolve one generation. Nothing is printed, if metrics is given it is called with a dict
+        holding generation number, population size, best and average fitness, number of fitness
+        evaluations so far and seconds spent in evaluation, selection, crossover and mutation
+        '''
+        start = time.perf_counter()
+        if minibatch is not None:
+            # estimate fitness of this generation from a random sample of points
+            points = self.sample_points(points, minibatch)
+        fitness_vector = self.calc_fitness_vector(points)
+        evaluated = time.perf_counter()
+        first, second = self.select_parents(fitness_vector)
+        selected = time.perf_counter()
         # perform crossover operation over population
-        self.crossover(points, self.get_fitness_list(points))
+        self.recombine(first, second)
         self.generation += 1
+        crossed = time.perf_counter()
         # perform mutation operation over newly created generation
         self.mutation(mutation_probability)
-        print("Generation no. ", self.get_generation(), " successfully evolved")
-        print("Pop: ", self.get_pop(), ", Best fitness: ", self.best_fit,
-              ", Avg Fitness: ", self.get_avgfit(points))
+        mutated = time.perf_counter()
         self.get_bestfit(points)
-        _avg_fit.append(self.get_avgfit(points))
+        if minibatch is not None:
+            self.update_elite(points, elite_size)
+        avg_fit = self.get_avgfit(points)
+        _avg_fit.append(avg_fit)
         _best_fit.append(self.best_fit)
-
-    def run(self, points, generation_number, mutation_probability=0.1):
+        if metrics is not None:
+            metrics({'generation': self.generation, 'pop': self.get_pop(), 'best_fit': self.best_fit,
+                     'avg_fit': avg_fit, 'evaluations': self.evaluations,
+                     'evaluation': evaluated - start + time.perf_counter() - mutated,
+                     'selection': selected - evaluated, 'crossover': crossed - selected,
+                     'mutation': mutated - crossed})
+
+    def save_checkpoint(self, path):
+        '''
+        Save state of the population into one binary .npz file: parameters of individuals and
+        their cached fitness, state of the random generator, generation, the best individual,
+        fitness history and elite.
+        The file is replaced only once it is completely written
+        '''
+        degree = self.coefficients.shape[1] - 1
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez(file, coefficients=self.coefficients,
+                     rng_state=json.dumps(self.rng.bit_generator.state),
+                     generation=self.generation, best_fit=self.best_fit,
+                     best_params=self.best_individual.polynomial.params, evaluations=self.evaluations,
+                     avg_fit_history=np.array(self.avg_fit_history, dtype=float),
+                     best_fit_history=np.array(self.best_fit_history, dtype=float),
+                     fitness=np.array([individual.fitness
+                                       if individual.fitness_version == individual.polynomial.version
+                                       else np.nan for individual in self.population], dtype=float),
+                     elite_fit=np.array([fit for fit, _ in self.elite], dtype=float),
+                     elite_params=np.array([individual.polynomial.params for _, individual in self.elite],
+                                           dtype=float).reshape(len(self.elite), degree + 1))
+        os.replace(temporary, path)
+
+    @classmethod
+    def from_checkpoint(cls, path, evaluator=population_fitness):
+        '''
+        Restore population saved by save_checkpoint, running it further on the same points
+        gives the same result (including number of evaluations) as if it had never been stopped
+        '''
+        population = cls(0, evaluator=evaluator)
+        with np.load(path) as checkpoint:
+            population.rng.bit_generator.state = json.loads(str(checkpoint['rng_state']))
+            population.coefficients = checkpoint['coefficients'].copy()
+            population.population = [Individual(params=params) for params in population.coefficients]
+            population.generation = int(checkpoint['generation'])
+            population.best_fit = float(checkpoint['best_fit'])
+            population.best_individual = Individual(params=checkpoint['best_params'].copy())
+            population.evaluations = int(checkpoint['evaluations'])
+            population.avg_fit_history = checkpoint['avg_fit_history'].tolist()
+            population.best_fit_history = checkpoint['best_fit_history'].tolist()
+            population.elite = [(float(fit), Individual(params=params.copy()))
+                                for fit, params in zip(checkpoint['elite_fit'], checkpoint['elite_params'])]
+            if 'fitness' in checkpoint.files:
+                population.checkpoint_fitness = checkpoint['fitness']
+        return population
+
+    def restore_fitness(self, points, minibatch=None):
+        '''
+        Put fitness values saved in the checkpoint back into caches of individuals, they were
+        computed on points of the run (in minibatch mode on a sample which is drawn again, so
+        they are dropped)
+        '''
+        if self.checkpoint_fitness is None:
+            return
+        if minibatch is None:
+            for individual, fitness in zip(self.population, self.checkpoint_fitness):
+                if not np.isnan(fitness):
+                    individual.set_cached_fitness(points, fitness)
+        self.checkpoint_fitness = None
+
+    def run(self, points, generation_number, mutation_probability=0.1, minibatch=None, elite_size=10,
+            metrics=None, checkpoint=None, checkpoint_every=10, termination=None):
         '''
         This method runs genetic algorithm over population
 
-        :param points: matrix nx3 (x, y, class) && class = {-1, 1}
-        :param generation_number: number of generations which will be generated during run
+        :param points: matrix nx3 (x, y, class) && class = {-1, 1}, numpy memmap and ChunkedPoints
+        are streamed chunk by chunk (see is_streamed), other matrices are kept in memory together
+        with their vandermonde matrix
+        :param generation_number: generation at which the run stops (unless termination is given)
         :param mutation_probability: probability of individual mutation <0, 1>
-        :return: (value of fitness of the best individual in whole run <0, 1>,
-        best individual in whole run, [] of average fitness over generations,
-        [] of best fitness over generations
+        :param minibatch: if given, fitness in every generation is estimated from this many
+        randomly drawn points and the elite is evaluated on all points at the end of the run
+        :param elite_size: number of the best individuals kept for the final evaluation
+        :param metrics: function called with metrics of every generation, e.g. JsonlMetrics or
+        print_metrics, see evolve_generation
+        :param checkpoint: path of the checkpoint file saved every checkpoint_every generations,
+        see save_checkpoint and from_checkpoint
+        :param checkpoint_every: number of generations between checkpoints
+        :param termination: Termination deciding when to stop, by default the run stops at
+        generation_number or when the best fitness reaches 1.0. The reason of stopping is kept
+        in stop_reason
+        :return: ([] of average fitness over generations, [] of best fitness over generations),
+        the best individual in whole run and its fitness are kept in best_individual and best_fit
         '''
-
-        _best_fit = []
-        _avg_fit = []
-        while self.best_fit > 0.95:
-            self.evolve_generation(points, _avg_fit, _best_fit, mutation_probability)
+        if termination is None:
+            termination = Termination(max_generations=generation_number, target_fitness=1.0)
+        termination.start()
+        self.restore_fitness(points, minibatch)
+        _best_fit = self.best_fit_history
+        _avg_fit = self.avg_fit_history
+        self.stop_reason = termination.check(self)
+        while self.stop_reason is None:
+            self.evolve_generation(points, _avg_fit, _best_fit, mutation_probability, minibatch, elite_size,
+                                   metrics)
+            if checkpoint is not None and self.generation % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint)
+            self.stop_reason = termination.check(self)
+        if minibatch is not None:
+            self.evaluate_elite(points)
 
         return _avg_fit, _best_fit
 
 
-def points_generator(clusters, _range=0.1, quantity=20):
-    points = []
-    for i in range(0, clusters.shape[0]):
-        for j in range(0, quantity):
-            x = random.uniform(clusters[i, 0]-_range, clusters[i, 0]+_range)
-            y = random.uniform(clusters[i, 1]-_range, clusters[i, 1]+_range)
-            _class = pow(-1, i)
-            point = (x, y, _class)
-            points.append(point)
-    return np.asarray(points)
+'''
+Island model. Every island is a Population evolved in its own process, every interval
+generations islands send copies of their best individuals to their neighbours in the topology,
+where they replace the worst individuals.
+'''
+
+
+def island_topology(topology, islands):
+    '''
+    :param topology: 'ring' (island i sends migrants to island i+1), 'full' (every island sends
+    migrants to all the others) or list of lists of destination islands of every island
+    :param islands: number of islands
+    :return: [[int]] list of destination islands of every island
+    '''
+    if topology == 'ring':
+        return [[(i + 1) % islands] for i in range(islands)] if islands > 1 else [[]]
+    if topology == 'full':
+        return [[j for j in range(islands) if j != i] for i in range(islands)]
+    return [list(destinations) for destinations in topology]
+
+
+def _run_island(index, pop, seed, points, generation_number, interval, migrants, mutation_probability,
+                destinations, sources, inboxes, results):
+    population = Population(pop, seed=seed)
+    _avg_fit = []
+    _best_fit = []
+    # messages of later migrations which arrived before all messages of the current one
+    early = []
+    for generation in range(1, generation_number + 1):
+        population.evolve_generation(points, _avg_fit, _best_fit, mutation_probability)
+        if generation % interval == 0 and generation < generation_number:
+            emigrants = population.emigrate(points, migrants)
+            for destination in destinations:
+                inboxes[destination].put((index, generation, emigrants))
+            arrived = [message for message in early if message[1] == generation]
+            early = [message for message in early if message[1] != generation]
+            while len(arrived) < sources:
+                message = inboxes[index].get()
+                if message[1] == generation:
+                    arrived.append(message)
+                else:
+                    early.append(message)
+            # migrants are taken in order of source islands, not of arrival, so runs are reproducible
+            for source, _, immigrants in sorted(arrived, key=lambda message: message[0]):
+                population.immigrate(points, immigrants)
+    results.put((index, population.best_fit, population.best_individual.polynomial.params,
+                 _avg_fit, _best_fit))
+
+
+def run_islands(points, islands=None, pop=100, generation_number=100, interval=10, migrants=2,
+                topology='ring', mutation_probability=0.1, seed=None):
+    '''
+    Run genetic algorithm on islands evolved in separate processes
+
+    :param points: matrix nx3 (x, y, class) && class = {-1, 1}
+    :param islands: number of islands (processes), number of cores when None
+    :param pop: number of individuals on every island
+    :param generation_number: number of generations evolved on every island
+    :param interval: number of generations between migrations
+    :param migrants: number of the best individuals sent by an island to every destination
+    :param topology: see island_topology
+    :param mutation_probability: probability of individual mutation <0, 1>
+    :param seed: seed from which seeds of islands are derived, runs with the same seed give the
+    same results
+    :return: (fitness of the best individual of all islands, the best individual,
+    [([] of average fitness, [] of best fitness) over generations of every island])
+    '''
+    if islands is None:
+        islands = os.cpu_count()
+    destinations = island_topology(topology, islands)
+    sources = [sum(i in island_destinations for island_destinations in destinations) for i in range(islands)]
+    seeds = np.random.SeedSequence(seed).generate_state(islands)
+    inboxes = [mp.Queue() for i in range(islands)]
+    results = mp.Queue()
+    processes = [mp.Process(target=_run_island,
+                            args=(i, pop, int(seeds[i]), points, generation_number, interval, migrants,
+                                  mutation_probability, destinations[i], sources[i], inboxes, results))
+                 for i in range(islands)]
+    for process in processes:
+        process.start()
+    finished = sorted(results.get() for i in range(islands))
+    for process in processes:
+        process.join()
+    best = max(finished, key=lambda result: result[1])
+    histories = [(result[3], result[4]) for result in finished]
+    return best[1], Individual(params=best[2]), histories
+
+
+def iter_points(clusters, quantity=20, _range=0.1, seed=None, dtype=np.float64, chunk_size=2**20):
+    '''
+    Generate points uniformly distributed in squares around cluster centres, chunk by chunk.
+    Points of cluster i have class (-1)^i
+
+    :param clusters: matrix kx2 of cluster centres
+    :param quantity: number of points of every cluster or sequence of k numbers
+    :param _range: half of side of square around centre
+    :param seed: seed of numpy random generator, the same seed gives the same points
+    :param dtype: numpy.float32 or numpy.float64
+    :param chunk_size: largest number of points in one chunk
+    :return: iterator over matrices mx3 (x, y, class)
+    '''
+    clusters = np.asarray(clusters, dtype=dtype)
+    counts = np.broadcast_to(np.asarray(quantity, dtype=np.int64), (clusters.shape[0],))
+    rng = np.random.default_rng(seed)
+    for i in range(clusters.shape[0]):
+        for start in range(0, int(counts[i]), chunk_size):
+            size = min(chunk_size, int(counts[i]) - start)
+            xy = rng.random((size, 2), dtype=dtype)
+            xy *= 2 * _range
+            xy += clusters[i] - _range
+            chunk = np.empty((size, 3), dtype=dtype)
+            chunk[:, :2] = xy
+            chunk[:, 2] = 1 if i % 2 == 0 else -1
+            yield chunk
+
+
+def generate_points(clusters, quantity=20, _range=0.1, seed=None, dtype=np.float64, path=None,
+                    chunk_size=2**20):
+    '''
+    Vectorized generator of labelled points, see iter_points. Points are written chunk by chunk,
+    so with path the whole set never has to fit in memory
+
+    :param path: .npy file the points are streamed to, they are kept in memory when None
+    :return: matrix nx3 (x, y, class), numpy memmap of the file when path is given
+    '''
+    counts = np.broadcast_to(np.asarray(quantity, dtype=np.int64), (np.shape(clusters)[0],))
+    shape = (int(counts.sum()), 3)
+    if path is None:
+        points = np.empty(shape, dtype=dtype)
+    else:
+        points = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    start = 0
+    for chunk in iter_points(clusters, counts, _range, seed, dtype, chunk_size):
+        points[start:start + chunk.shape[0]] = chunk
+        start += chunk.shape[0]
+    if path is not None:
+        points.flush()
+    return points
+
+
+def points_generator(clusters, _range=0.1, quantity=20, seed=None):
+    return generate_points(clusters, quantity, _range, seed)
+
+
+def random_search(points, batch_size=4096, max_samples=None, seed=None, evaluator=population_fitness,
+                  degree=3):
+    '''
+    Batched random search. Every iteration draws batch_size random polynomials as one matrix of
+    parameters and evaluates all of them at once
+
+    :param points: matrix nx3 (x, y, class) && class = {-1, 1}, numpy memmap and ChunkedPoints
+    are streamed chunk by chunk (see is_streamed)
+    :param batch_size: number of polynomials drawn in every iteration
+    :param max_samples: stop after this many polynomials, search until fitness 1.0 when None
+    :param seed: seed of numpy random generator
+    :param evaluator: function (coefficients, points, vander) -> vector of fitness values
+    :param degree: degree of polynomials
+    :return: (fitness of the best individual, the best individual, number of polynomials tried)
+    '''
+    rng = np.random.default_rng(seed)
+    vander = None if is_streamed(points) else vandermonde(points[:, 0], degree)
+    best_fit = 0.0
+    best_params = None
+    samples = 0
+    start = time.time()
+    while best_fit < 1.0 and (max_samples is None or samples < max_samples):
+        size = batch_size if max_samples is None else min(batch_size, max_samples - samples)
+        coefficients = rng.uniform(-10.0, 10.0, size=(size, degree + 1))
+        fitness_vector = evaluator(coefficients, points, vander)
+        samples += size
+        best = int(np.argmax(fitness_vector))
+        if best_params is None or fitness_vector[best] > best_fit:
+            best_fit = float(fitness_vector[best])
+            best_params = coefficients[best].copy()
+    elapsed = time.time() - start
+    print("Tried ", samples, " polynomials, ", samples / elapsed if elapsed else 0.0, " polynomials/s")
+    return best_fit, Individual(params=best_params), samples
 
 
 def brute_force(points):
-    individual = Individual()
-    while individual.calc_fitness(points) != 1.0:
-        individual = Individual()
-    return individual
+    return random_search(points)[1]
 
-if __name__ == "__main__":
-    clusters = np.array([[0.1, 0.1], [0.35, 0.4], [0.6, 0.1]])
-    population = Population(100)
-    data_set = points_generator(clusters)
+class JsonlMetrics:
+    def __init__(self, path):
+        '''Metrics hook appending metrics of every generation as one JSON line to the file'''
+        self.file = open(path, 'a')
+
+    def __call__(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
 
-    start = time.time()
-    # BRUTAL
-    # best_poly = brute_force(data_set)
-    # polynomial = np.poly1d(best_poly.polynomial.params.transpose())
-    avg_fit, best_fit = population.run(data_set, 100, mutation_probability=0.2)
-    stop = time.time()
-    print("Time elapsed: ", stop - start, "s")
+
+def print_metrics(record):
+    print("Generation no. ", record['generation'], " successfully evolved")
+    print("Pop: ", record['pop'], ", Best fitness: ", record['best_fit'],
+          ", Avg Fitness: ", record['avg_fit'])
+
+
+def plot_results(points, best_individual, avg_fit, best_fit):
+    '''
+    Plot points with the best polynomial and best and average fitness over generations.
+    matplotlib is imported only here, so the rest of the module runs without a display
+    '''
+    import matplotlib.pyplot as plt
 
     # plot best individual and points
-    polynomial = np.poly1d(population.best_individual.polynomial.params.transpose())
+    polynomial = np.poly1d(best_individual.polynomial.params.transpose())
     x = np.linspace(0.0, 0.75, 100)
     y = polynomial(x)
     my_colors = np.array(['tab:blue', 'tab:orange'])
-    for i in range(0, data_set[:, :].shape[0]):
-        if data_set[i, 2] == -1:
-            data_set[i, 2] = 0
-    plt.scatter(x=data_set[:, 0], y=data_set[:, 1], c=my_colors[data_set[:, 2].astype(int)])
+    classes = (points[:, 2] == 1).astype(int)
+    plt.scatter(x=points[:, 0], y=points[:, 1], c=my_colors[classes])
     plt.plot(x, y)
     plt.show()
 
@@ -233,4 +891,102 @@ if __name__ == "__main__":
     plt.show()
 
 
+BENCHMARK_CLUSTERS = np.array([[0.1, 0.1], [0.35, 0.4], [0.6, 0.1]])
+BENCHMARK_FIELDS = ['pop', 'degree', 'points', 'generations', 'seconds', 'generations_per_s',
+                    'evaluations', 'evaluations_per_s', 'evaluation', 'selection', 'crossover', 'mutation',
+                    'best_fit', 'peak_memory']
+
+
+def _benchmark_run(points, pop, degree, generations, seed, metrics=None):
+    population = Population(pop, seed=seed, degree=degree)
+    population.run(points, generations, metrics=metrics, termination=Termination(max_generations=generations))
+    return population
+
+
+def benchmark_ga(pops, degrees, sizes, generations=20, seed=0, output="ga_benchmark.csv"):
+    '''
+    Run the genetic algorithm for every combination of population size, degree and number of
+    points. Every run evolves exactly generations generations on points of BENCHMARK_CLUSTERS
+    generated with the same seed, so results of different versions of the code are comparable
+
+    :param pops: iterable of population sizes
+    :param degrees: iterable of degrees of polynomials
+    :param sizes: iterable of numbers of points
+    :param generations: number of generations of every run
+    :param seed: seed of points and populations
+    :param output: path of CSV file with results, columns are BENCHMARK_FIELDS
+    :return: [dict] list of records written to the output
+    '''
+    records = []
+    with open(output, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=BENCHMARK_FIELDS)
+        writer.writeheader()
+        print(("{:>8}" * 4 + "{:>12}" * 2 + "{:>12}" * 4 + "{:>14}").format(
+            'pop', 'degree', 'points', 'gens', 'gen/s', 'eval/s', 'evaluation', 'selection', 'crossover',
+            'mutation', 'peak bytes'))
+        for size in sizes:
+            points = generate_points(BENCHMARK_CLUSTERS, -(-size // BENCHMARK_CLUSTERS.shape[0]), seed=seed)
+            for pop in pops:
+                for degree in degrees:
+                    phases = {'evaluation': 0.0, 'selection': 0.0, 'crossover': 0.0, 'mutation': 0.0}
+
+                    def add_phases(record):
+                        for phase in phases:
+                            phases[phase] += record[phase]
+
+                    start = time.perf_counter()
+                    population = _benchmark_run(points, pop, degree, generations, seed, add_phases)
+                    seconds = time.perf_counter() - start
+                    tracemalloc.start()
+                    _benchmark_run(points, pop, degree, generations, seed)
+                    peak_memory = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    record = {'pop': pop, 'degree': degree, 'points': points.shape[0],
+                              'generations': population.generation, 'seconds': seconds,
+                              'generations_per_s': population.generation / seconds,
+                              'evaluations': population.evaluations,
+                              'evaluations_per_s': population.evaluations / seconds,
+                              'best_fit': population.best_fit, 'peak_memory': peak_memory}
+                    record.update(phases)
+                    writer.writerow(record)
+                    file.flush()
+                    records.append(record)
+                    print(("{:>8}" * 4 + "{:>12.1f}" * 2 + "{:>12.4f}" * 4 + "{:>14}").format(
+                        pop, degree, points.shape[0], population.generation, record['generations_per_s'],
+                        record['evaluations_per_s'], phases['evaluation'], phases['selection'],
+                        phases['crossover'], phases['mutation'], peak_memory))
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find polynomial separating two classes of points")
+    parser.add_argument("--headless", action="store_true", help="do not plot results")
+    parser.add_argument("--metrics", help="JSON lines file for metrics of generations, "
+                                          "they are printed when not given")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="benchmark all combinations of --pops, --degrees and --sizes")
+    parser.add_argument("--pops", type=int, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--degrees", type=int, nargs="+", default=[3, 5])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[60, 10000, 1000000])
+    parser.add_argument("--generations", type=int, default=20, help="generations of every benchmark run")
+    parser.add_argument("--output", default="ga_benchmark.csv", help="CSV file with benchmark results")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_ga(args.pops, args.degrees, args.sizes, args.generations, output=args.output)
+        raise SystemExit
+    metrics = JsonlMetrics(args.metrics) if args.metrics else print_metrics
+
+    clusters = np.array([[0.1, 0.1], [0.35, 0.4], [0.6, 0.1]])
+    population = Population(100)
+    data_set = points_generator(clusters)
+
+    start = time.time()
+    # BRUTAL
+    # best_poly = brute_force(data_set)
+    # polynomial = np.poly1d(best_poly.polynomial.params.transpose())
+    avg_fit, best_fit = population.run(data_set, 100, mutation_probability=0.2, metrics=metrics)
+    stop = time.time()
+    print("Time elapsed: ", stop - start, "s, stopped by ", population.stop_reason)
 
+    if not args.headless:
+        plot_results(data_set, population.best_individual, avg_fit, best_fit)
@@ -1,5 +1,6 @@
 import time
 import functools
+import heapq
 
 class Variable:
     #
@@ -11,16 +12,27 @@ class Variable:
         '''
         self.name = name                #text name for variable
         self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        self.index = dict()             #value -> index in dom
+        for i, val in enumerate(self.dom):
+            self.index.setdefault(val, i)
+        self.curdom = bytearray(b'\x01' * len(domain))  #1 if value is in CURRENT domain
+        self.curdom_size = len(domain)  #number of ones in curdom
         #for bt_search
         self.assignedValue = None
+        self.cons = []                  #constraints over the variable, their
+                                        #unassigned counters follow assign/unassign
+        self.csps = []                  #CSPs told about assign/unassign and
+                                        #changes of the current domain
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
+            self.index.setdefault(val, len(self.dom))
             self.dom.append(val)
-            self.curdom.append(True)
+            self.curdom.append(1)
+            self.curdom_size += 1
+        self.domain_changed()
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -36,46 +48,47 @@ class Variable:
 
     def prune_value(self, value):
         '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        i = self.value_index(value)
+        if self.curdom[i]:
+            self.curdom[i] = 0
+            self.curdom_size -= 1
+            self.domain_changed()
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        i = self.value_index(value)
+        if not self.curdom[i]:
+            self.curdom[i] = 1
+            self.curdom_size += 1
+            self.domain_changed()
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
-        vals = []
         if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
-        return vals
+            return [self.assignedValue]
+        return [val for val, live in zip(self.dom, self.curdom) if live]
 
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
-            return False
-        if self.is_assigned():
-            return value == self.get_assigned_value()
-        else:
-            return self.curdom[self.value_index(value)]
+        if self.assignedValue is not None:
+            return value == self.assignedValue and value in self.index
+        i = self.index.get(value)
+        return i is not None and self.curdom[i] == 1
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
-        if self.is_assigned():
+        if self.assignedValue is not None:
             return 1
-        else:
-            return(sum(1 for v in self.curdom if v))
+        return self.curdom_size
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.curdom = bytearray(b'\x01' * len(self.dom))
+        self.curdom_size = len(self.dom)
+        self.domain_changed()
 
     #
     #methods for assigning and unassigning
@@ -95,6 +108,10 @@ class Variable:
             return
 
         self.assignedValue = value
+        for c in self.cons:
+            c.n_unasgn -= 1
+        for csp in self.csps:
+            csp.var_assigned(self)
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
@@ -102,6 +119,10 @@ class Variable:
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
         self.assignedValue = None
+        for c in self.cons:
+            c.n_unasgn += 1
+        for csp in self.csps:
+            csp.var_unassigned(self)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
@@ -111,10 +132,15 @@ class Variable:
     #internal methods
     #
 
+    def domain_changed(self):
+        '''Tell CSPs holding the variable that size of CURRENT domain changed'''
+        for csp in self.csps:
+            csp.domain_changed(self)
+
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        return self.index[value]
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -126,7 +152,7 @@ class Variable:
         '''Also print the variable domain and current domain'''
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             [bool(live) for live in self.curdom]))
 class Constraint:
 
     def __init__(self, name, scope):
@@ -140,6 +166,19 @@ class Constraint:
         #pair.
         self.sup_tuples = dict()
 
+        #index in sup_tuples[(var,val)] of the last support found for
+        #the pair. It is only a hint where to start looking, so it stays
+        #correct when pruned values are restored
+        self.residues = dict()
+
+        #number of unassigned variables in scope, kept up to date by
+        #Variable.assign and Variable.unassign
+        self.n_unasgn = 0
+        for v in self.scope:
+            v.cons.append(self)
+            if not v.is_assigned():
+                self.n_unasgn += 1
+
     def add_satisfying_tuples(self, tuples):
         '''We specify the constraint by adding its complete list of satisfying tuples.'''
         for x in tuples:
@@ -169,11 +208,7 @@ class Constraint:
 
     def get_n_unasgn(self):
         '''return the number of unassigned variables in the constraint's scope'''
-        n = 0
-        for v in self.scope:
-            if not v.is_assigned():
-                n = n + 1
-        return n
+        return self.n_unasgn
 
     def get_unasgn_vars(self): 
         '''return list of unassigned variables in constraint's scope. Note
@@ -187,25 +222,78 @@ class Constraint:
     def has_support(self, var, val):
         '''Test if a variable value pair has a supporting tuple (a set
            of assignments satisfying the constraint where each value is
-           still in the corresponding variables current domain
+           still in the corresponding variables current domain.
+           The last support found for the pair is checked first
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
-                if self.tuple_is_valid(t):
-                    return True
+        tuples = self.sup_tuples.get((var, val))
+        if not tuples:
+            return False
+        residue = self.residues.get((var, val), 0)
+        if residue and self.tuple_is_valid(tuples[residue]):
+            return True
+        for i, t in enumerate(tuples):
+            if self.tuple_is_valid(t):
+                if i != residue:
+                    self.residues[(var, val)] = i
+                return True
         return False
 
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
            corresponding variable domains'''
-        for i, var in enumerate(self.scope):
-            if not var.in_cur_domain(t[i]):
+        for var, val in zip(self.scope, t):
+            if not var.in_cur_domain(val):
                 return False
         return True
 
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class VarQueue:
+    '''Binary heap of variables ordered by size of their CURRENT domain,
+       ties are broken by order (dict variable -> int). Entries are not
+       removed when a variable is assigned or its domain changes. A new
+       entry is pushed instead and stale entries are dropped at top()'''
+
+    def __init__(self, order):
+        self.heap = []      #entries (domain size, order, variable)
+        self.keys = dict()  #variable -> key of its live entry in heap
+        self.order = order
+
+    def __len__(self):
+        return len(self.heap)
+
+    def top(self):
+        '''return unassigned variable with the smallest domain, None if
+           there is none'''
+        heap = self.heap
+        while heap:
+            size, i, var = heap[0]
+            if self.keys.get(var) == (size, i):
+                if not var.is_assigned():
+                    return var
+                #pushed again when unassigned
+                del self.keys[var]
+            heapq.heappop(heap)
+        return None
+
+    def push(self, var):
+        '''add an entry for an unassigned var unless its live entry
+           already has the current key'''
+        key = (var.cur_domain_size(), self.order[var])
+        if self.keys.get(var) != key:
+            if len(self.heap) > 4 * len(self.order):
+                self.compact()
+            self.keys[var] = key
+            heapq.heappush(self.heap, key + (var,))
+
+    def compact(self):
+        '''rebuild heap from the live entries of unassigned variables'''
+        self.heap = [key + (var,) for var, key in self.keys.items()
+                     if not var.is_assigned() and key[0] == var.cur_domain_size()]
+        self.keys = {entry[2]: entry[:2] for entry in self.heap}
+        heapq.heapify(self.heap)
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -220,6 +308,9 @@ class CSP:
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        self.var_index = dict()     #variable -> index in vars
+        self.n_unasgn_vars = 0
+        self.mrv_queue = VarQueue(self.var_index) #unassigned variables by domain size
         for v in vars:
             self.add_var(v)
 
@@ -231,8 +322,12 @@ class CSP:
         elif v in self.vars_to_cons:
             print("Trying to add variable ", v, " to CSP object that already has it")
         else:
+            self.var_index[v] = len(self.vars)
             self.vars.append(v)
             self.vars_to_cons[v] = []
+            v.csps.append(self)
+            if not v.is_assigned():
+                self.var_unassigned(v)
 
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
@@ -260,9 +355,35 @@ class CSP:
         return list(self.vars)
 
     def get_all_unasgn_vars(self):
-        '''return list of unassigned variables in the CSP'''
+        '''return list of unassigned variables in the CSP (in the order
+           of variables)'''
         return [v for v in self.vars if not v.is_assigned()]
 
+    def get_n_unasgn_vars(self):
+        '''return the number of unassigned variables in the CSP'''
+        return self.n_unasgn_vars
+
+    def get_mrv_var(self):
+        '''return unassigned variable with the smallest CURRENT domain
+           (the first one in the order of variables on ties), None if
+           all variables are assigned'''
+        return self.mrv_queue.top()
+
+    #
+    #called by Variable to keep unassigned variables up to date
+    #
+
+    def var_assigned(self, v):
+        self.n_unasgn_vars -= 1
+
+    def var_unassigned(self, v):
+        self.n_unasgn_vars += 1
+        self.mrv_queue.push(v)
+
+    def domain_changed(self, v):
+        if not v.is_assigned():
+            self.mrv_queue.push(v)
+
     def print_all(self):
         print("CSP", self.name)
         print("   Variables = ", self.vars)
@@ -273,10 +394,11 @@ class CSP:
         print("CSP", self.name, " Assignments = ")
         previous_row = 1
         for v in self.vars:
-            if int(str(v)[-3]) != previous_row:
+            row = int(v.name[1:].split(',')[0])
+            if row != previous_row:
                 print("")
                 print(v.get_assigned_value(), "    ", end='')
-                previous_row = int(str(v)[-3])
+                previous_row = row
             else:
                 print(v.get_assigned_value(), "    ", end='')
         print("")
@@ -294,7 +416,7 @@ class BT:
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
-        unasgn_vars = list() #used to track unassigned variables
+                            #unassigned variables are tracked by the csp
         self.TRACE = False
         self.runtime = 0
 
@@ -330,10 +452,6 @@ class BT:
                 var.unassign()
             var.restore_curdom()
 
-    def restoreUnasgnVar(self, var):
-        '''Add variable back to list of unassigned vars'''
-        self.unasgn_vars.append(var)
-        
     def bt_search(self,propagator,var_ord,val_ord):
         '''Try to solve the CSP using specified propagator routine
 
@@ -374,17 +492,12 @@ class BT:
         stime = time.process_time()
 
         self.restore_all_variable_domains()
-        
-        self.unasgn_vars = []
-        for v in self.csp.vars:
-            if not v.is_assigned():
-                self.unasgn_vars.append(v)
 
         status, prunings = propagator(self.csp) #initial propagate no assigned variables.
         self.nPrunings = self.nPrunings + len(prunings)
 
         if self.TRACE:
-            print(len(self.unasgn_vars), " unassigned variables at start of search")
+            print(self.csp.get_n_unasgn_vars(), " unassigned variables at start of search")
             print("Root Prunings: ", prunings)
 
         if status == False:
@@ -412,14 +525,13 @@ class BT:
         if self.TRACE:
             print('  ' * level, "bt_recurse level ", level)
            
-        if not self.unasgn_vars:
+        if self.csp.get_n_unasgn_vars() == 0:
             #all variables assigned
             return True
         else:
-            ##Figure out which variable to assign,
-            ##Then remove it from the list of unassigned vars
+            ##Figure out which variable to assign, the csp stops
+            ##counting it as unassigned once it is assigned
             var = var_ord(self.csp)
-            self.unasgn_vars.remove(var) 
 
             if self.TRACE:
                 print('  ' * level, "bt_recurse var = ", var)
@@ -450,6 +562,5 @@ class BT:
                 self.restoreValues(prunings)
                 var.unassign()
 
-            self.restoreUnasgnVar(var)
             return False
 
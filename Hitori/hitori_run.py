@@ -10,6 +10,10 @@ def solve_hitori(initial_hitori_board, propType, var_ord_type, val_ord_type, tra
         solver.trace_on()
     if propType == 'BT':
         solver.bt_search(prop_BT, var_ord_type, val_ord_type)
+    elif propType == 'FC':
+        solver.bt_search(prop_FC, var_ord_type, val_ord_type)
+    elif propType == 'GAC':
+        solver.bt_search(prop_GAC, var_ord_type, val_ord_type)
 
 
 if __name__ == "__main__":
@@ -56,13 +56,8 @@ def ord_mrv(csp):
     (i.e., the variable with the fewest legal values).
     '''
     #IMPLEMENT
-    vars_list = csp.get_all_unasgn_vars()
-    min_val = 99999
-    for var in vars_list:
-        if var.cur_domain_size() < min_val:
-            min_val = var.cur_domain_size()
-            min_var = var
-    return min_var
+    #the csp keeps unassigned variables in a heap keyed by domain size
+    return csp.get_mrv_var()
         
 def ord_dh(csp):
     '''
@@ -1,3 +1,6 @@
+from collections import deque
+
+
 def prop_BT(csp, newVar=None):
     '''Do plain backtracking propagation. That is, do no
     propagation at all. Just check fully instantiated constraints'''
@@ -15,3 +18,71 @@ def prop_BT(csp, newVar=None):
     return True, []
 
 
+
+
+def FC_check(c, x):
+    '''Prune values of the only unassigned variable x of constraint c that cannot be
+    completed to a satisfying tuple. Return (False, prunings) if x's domain is wiped out'''
+    pruned = []
+    vals = []
+    for var in c.get_scope():
+        vals.append(var.get_assigned_value())
+    index = c.get_scope().index(x)
+    for val in x.cur_domain():
+        vals[index] = val
+        if not c.check(vals):
+            x.prune_value(val)
+            pruned.append((x, val))
+    return x.cur_domain_size() > 0, pruned
+
+
+def prop_FC(csp, newVar=None):
+    '''Do forward checking. That is check constraints with
+       only one uninstantiated variable. Remember to keep
+       track of all pruned variable,value pairs and return '''
+
+    if not newVar:
+        cons = csp.get_all_cons()
+    else:
+        cons = csp.get_cons_with_var(newVar)
+    prunings = []
+    for c in cons:
+        if c.get_n_unasgn() == 1:
+            status, pruned = FC_check(c, c.get_unasgn_vars()[0])
+            prunings.extend(pruned)
+            if not status:
+                return False, prunings
+    return True, prunings
+
+
+def prop_GAC(csp, newVar=None):
+    '''Do GAC propagation. If newVar is None we do initial GAC enforce
+       processing all constraints. Otherwise we do GAC enforce with
+       constraints containing newVar on GAC Queue. Only constraints over
+       variables whose domains were pruned are put back on the queue'''
+
+    if not newVar:
+        queue = deque(csp.get_all_cons())
+    else:
+        queue = deque(csp.get_cons_with_var(newVar))
+    queued = set(queue)
+    prunings = []
+    while queue:
+        c = queue.popleft()
+        queued.discard(c)
+        for var in c.get_scope():
+            pruned = False
+            for val in var.cur_domain():
+                if not c.has_support(var, val):
+                    var.prune_value(val)
+                    prunings.append((var, val))
+                    pruned = True
+            if not pruned:
+                continue
+            if var.cur_domain_size() == 0:
+                return False, prunings
+            for other in csp.get_cons_with_var(var):
+                if other is not c and other not in queued:
+                    queue.append(other)
+                    queued.add(other)
+    return True, prunings